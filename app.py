@@ -1,13 +1,17 @@
 import streamlit as st
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker
 from io import BytesIO
+import hashlib
+from operator import attrgetter
 
 from payments_import import (
-    import_statement,
+    read_sber_statement_excel,
+    parse_statement_to_payments,
+    attach_apartment_ids,
     save_payments_to_db,
-    Base,
+    init_schema,
     Apartment,
 )
 
@@ -41,9 +45,66 @@ st.markdown("""
 # ======================================================
 
 DATABASE_URL = "sqlite:///jsk.db"
-engine = create_engine(DATABASE_URL, echo=False)
-SessionLocal = sessionmaker(bind=engine)
-Base.metadata.create_all(engine)
+
+
+@st.cache_resource
+def get_engine():
+    """Один движок (и пул соединений) на процесс, а не на каждый перезапуск."""
+    return create_engine(
+        DATABASE_URL,
+        echo=False,
+        connect_args={"check_same_thread": False},
+        pool_pre_ping=True,
+    )
+
+
+@st.cache_resource
+def get_sessionmaker():
+    # сессии только читают и пишут пакетами — autoflush не нужен,
+    # а после commit объекты не перечитываются
+    return sessionmaker(
+        bind=get_engine(),
+        autoflush=False,
+        expire_on_commit=False,
+    )
+
+
+@st.cache_resource
+def ensure_schema() -> bool:
+    """Создание таблиц и индексов — один раз на процесс, а не на каждый перезапуск."""
+    init_schema(get_engine())
+    return True
+
+
+SessionLocal = get_sessionmaker()
+ensure_schema()
+
+
+@st.cache_data(ttl=300)
+def load_apartment_map() -> dict[str, int]:
+    """Справочник квартир для ручного сопоставления: «Кв N» -> id."""
+    session = SessionLocal()
+    try:
+        # только id/number — кортежи без гидрации ORM-объектов
+        rows = session.execute(
+            select(Apartment.id, Apartment.number).order_by(Apartment.number)
+        ).all()
+        return {f"Кв {number}": apt_id for apt_id, number in rows}
+    finally:
+        session.close()
+
+
+@st.cache_data(show_spinner=False)
+def parse_uploaded_statement(file_bytes: bytes):
+    """
+    Разбор выписки, кешируется по содержимому файла —
+    повторные перезапуски скрипта не перечитывают Excel.
+    Файл читается прямо из памяти, без копии на диске.
+    Сопоставление с квартирами в кеш не входит: справочник
+    в БД может измениться, поэтому оно делается на каждом запуске.
+    """
+    df = read_sber_statement_excel(BytesIO(file_bytes))
+    return parse_statement_to_payments(df)
 
 
 # ======================================================
@@ -51,17 +112,31 @@ Base.metadata.create_all(engine)
 # ======================================================
 
 def payments_to_dataframe(payments):
-    return pd.DataFrame([
-        {
-            "Дата": p.date.strftime("%Y-%m-%d"),
-            "Сумма": float(p.amount),
-            "Описание": p.description,
-            "Отправитель": p.sender_info,
-            "Автоопределение": p.guessed_apartment_number,
-            "Квартира ID": p.apartment_id,
-        }
-        for p in payments
-    ])
+    df = pd.DataFrame.from_records(
+        map(attrgetter(
+            "date",
+            "amount",
+            "description",
+            "sender_info",
+            "guessed_apartment_number",
+            "apartment_id",
+        ), payments),
+        columns=[
+            "Дата",
+            "Сумма",
+            "Описание",
+            "Отправитель",
+            "Автоопределение",
+            "Квартира ID",
+        ],
+    )
+
+    # форматирование — одним проходом по колонке, а не построчно
+    df["Дата"] = pd.to_datetime(df["Дата"]).dt.strftime("%Y-%m-%d")
+    df["Сумма"] = df["Сумма"].astype("float64")
+    df["Отправитель"] = df["Отправитель"].astype("category")
+
+    return df
 
 
 def charges_to_df(rows: list[ChargeRow]):
@@ -77,23 +152,36 @@ def charges_to_df(rows: list[ChargeRow]):
     ])
 
 
+MAX_COLUMN_WIDTH = 60
+
+
 def excel_bytes_from_df(dfs: dict):
     """Создаёт Excel с несколькими листами."""
     output = BytesIO()
-    writer = pd.ExcelWriter(output, engine="openpyxl")
+    # xlsxwriter — только запись, без объектной модели книги;
+    # in_memory: собирать файл прямо в памяти, без временных файлов
+    writer = pd.ExcelWriter(
+        output,
+        engine="xlsxwriter",
+        engine_kwargs={"options": {"in_memory": True}},
+    )
 
     for sheet, df in dfs.items():
         df.to_excel(writer, sheet_name=sheet, index=False)
 
-        ws = writer.book[sheet]
+        ws = writer.sheets[sheet]
 
-        # автоширина
-        for col in ws.columns:
-            max_len = max(len(str(c.value)) if c.value else 0 for c in col)
-            ws.column_dimensions[col[0].column_letter].width = max_len + 2
+        if len(df.columns) == 0:
+            continue
 
-        ws.auto_filter.ref = ws.dimensions
-        ws.freeze_panes = "A2"
+        # автоширина — длины строк считаются pandas по колонкам целиком
+        lengths = df.astype("string").apply(lambda s: s.str.len()).max().fillna(0)
+        for i, col in enumerate(df.columns):
+            max_len = max(int(lengths[col]), len(str(col)))
+            ws.set_column(i, i, min(max_len + 2, MAX_COLUMN_WIDTH))
+
+        ws.autofilter(0, 0, len(df), len(df.columns) - 1)
+        ws.freeze_panes(1, 0)
 
     writer.close()
     output.seek(0)
@@ -112,6 +200,8 @@ mode = st.sidebar.radio("Раздел:", ["Платежи", "Начислени
 # РАЗДЕЛ 1 — ПЛАТЕЖИ
 # ======================================================
 
+NOT_SELECTED = "Не выбрано"
+
 if mode == "Платежи":
 
     session = SessionLocal()
@@ -121,50 +211,61 @@ if mode == "Платежи":
     uploaded = st.file_uploader("Выберите файл .xlsx", type=["xlsx"])
 
     if uploaded:
-        temp_path = "uploaded_statement.xlsx"
-        with open(temp_path, "wb") as f:
-            f.write(uploaded.read())
-
         st.success("Файл загружен. Обрабатываю…")
 
-        matched, unmatched = import_statement(temp_path, session)
+        file_bytes = uploaded.getvalue()
+        parsed = parse_uploaded_statement(file_bytes)
+        matched, unmatched = attach_apartment_ids(parsed, session)
+
+        # таблицы для отображения строятся один раз на файл
+        # и результат сопоставления (справочник квартир мог измениться)
+        digest = hashlib.md5(file_bytes)
+        digest.update(repr([p.apartment_id for p in matched]).encode())
+        statement_key = digest.hexdigest()
+        if st.session_state.get("statement_key") != statement_key:
+            st.session_state.statement_key = statement_key
+            st.session_state.matched_df = payments_to_dataframe(matched)
+            st.session_state.unmatched_df = payments_to_dataframe(unmatched)[
+                ["Дата", "Сумма", "Описание", "Отправитель", "Автоопределение"]
+            ].rename(columns={"Автоопределение": "Авто"})
 
         # ---------- автоматические ----------
         st.subheader("Автоматически распознанные платежи")
-        st.dataframe(payments_to_dataframe(matched), use_container_width=True)
+        st.dataframe(st.session_state.matched_df, use_container_width=True)
 
         # ---------- ручное распределение ----------
         st.subheader("Платежи, требующие ручного сопоставления")
 
-        apt_map = {f"Кв {a.number}": a.id for a in session.query(Apartment).all()}
-
-        cols = st.columns([1, 1, 3, 1, 2])
-        cols[0].markdown("**Дата**")
-        cols[1].markdown("**Сумма**")
-        cols[2].markdown("**Описание**")
-        cols[3].markdown("**Авто**")
-        cols[4].markdown("**Квартира**")
-
-        for idx, p in enumerate(unmatched):
-            row = st.columns([1, 1, 3, 1, 2])
-            row[0].write(p.date.strftime("%Y-%m-%d"))
-            row[1].write(float(p.amount))
-            row[2].write(p.description)
-            row[3].write(p.guessed_apartment_number)
-
-            choice = row[4].selectbox(
-                "",
-                ["Не выбрано"] + list(apt_map.keys()),
-                key=f"apt_choice_{idx}"
-            )
-
-            if choice != "Не выбрано":
+        apt_map = load_apartment_map()
+        apt_options = (NOT_SELECTED, *apt_map)
+
+        df_unmatched = st.session_state.unmatched_df.copy()
+        df_unmatched["Квартира"] = NOT_SELECTED
+
+        edited = st.data_editor(
+            df_unmatched,
+            column_config={
+                "Квартира": st.column_config.SelectboxColumn(
+                    options=apt_options,
+                    required=True,
+                ),
+            },
+            disabled=["Дата", "Сумма", "Описание", "Отправитель", "Авто"],
+            hide_index=True,
+            use_container_width=True,
+            key=f"unmatched_editor_{statement_key}",
+        )
+
+        for p, choice in zip(unmatched, edited["Квартира"]):
+            if choice != NOT_SELECTED:
                 p.apartment_id = apt_map[choice]
 
         if st.button("📌 Провести платежи"):
 
-            final_matched = matched + [p for p in unmatched if p.apartment_id]
-            final_unmatched = [p for p in unmatched if not p.apartment_id]
+            final_matched = list(matched)
+            final_unmatched = []
+            for p in unmatched:
+                (final_matched if p.apartment_id else final_unmatched).append(p)
 
             save_payments_to_db(session, final_matched, final_unmatched)
             st.success("Платежи сохранены!")
@@ -172,7 +273,8 @@ if mode == "Платежи":
         # ------- отчёт -------
         st.download_button(
             "📥 Скачать отчёт",
-            data=excel_bytes_from_df({
+            # отчёт собирается только по нажатию кнопки, а не на каждом перезапуске
+            data=lambda: excel_bytes_from_df({
                 "Распознанные": payments_to_dataframe(matched),
                 "Нераспознанные": payments_to_dataframe(unmatched),
             }),
@@ -208,7 +310,7 @@ elif mode == "Начисления":
 
         st.download_button(
             "📥 Скачать начисления",
-            data=excel_bytes_from_df({"Начисления": df_charges}),
+            data=lambda: excel_bytes_from_df({"Начисления": df_charges}),
             file_name=f"Начисления_{year}-{month}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         )
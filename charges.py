@@ -5,12 +5,15 @@ from dataclasses import dataclass
 from datetime import date, datetime
 from typing import List, Dict
 
+import numpy as np
 from sqlalchemy import (
-    Column, Integer, String, Date, DateTime, Numeric, Float, ForeignKey
+    Column, Integer, String, Date, DateTime, Numeric, Float, ForeignKey,
+    Index, and_, bindparam, delete, func, select,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import relationship, Session
 
-from payments_import import Base, Apartment  # используем существующую модель Apartment
+from payments_import import Base, Apartment, INSERT_PAGE_SIZE, init_schema  # используем существующую модель Apartment
 
 
 # =========================================================
@@ -28,6 +31,9 @@ class TariffItem(Base):
     - bank_percent  (%)
     """
     __tablename__ = "tariff_items"
+    __table_args__ = (
+        Index("ix_tariff_code_from", "code", "valid_from"),
+    )
 
     id = Column(Integer, primary_key=True)
     code = Column(String, nullable=False, index=True)
@@ -42,6 +48,14 @@ class Charge(Base):
     Строка начисления за месяц по квартире.
     """
     __tablename__ = "charges"
+    __table_args__ = (
+        # одна строка на квартиру/период/услугу — ключ для upsert
+        Index(
+            "ux_charge_apartment_period_item",
+            "apartment_id", "period", "item_code",
+            unique=True,
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     apartment_id = Column(Integer, ForeignKey("apartments.id"), nullable=False)
@@ -75,119 +89,134 @@ def month_start(year: int, month: int) -> date:
 def get_active_tariffs(session: Session, period: date) -> Dict[str, TariffItem]:
     """
     Возвращает самые свежие тарифы с valid_from <= period.
+    Последняя версия по каждому code выбирается в SQL,
+    из базы приходят только действующие тарифы.
     """
-    items = session.query(TariffItem).all()
-    result: Dict[str, TariffItem] = {}
-
-    for t in items:
-        if t.valid_from <= period:
-            prev = result.get(t.code)
-            if prev is None or prev.valid_from < t.valid_from:
-                result[t.code] = t
+    latest = (
+        session.query(
+            TariffItem.code,
+            func.max(TariffItem.valid_from).label("valid_from"),
+        )
+        .filter(TariffItem.valid_from <= period)
+        .group_by(TariffItem.code)
+        .subquery()
+    )
+
+    items = (
+        session.query(TariffItem)
+        .join(latest, and_(
+            TariffItem.code == latest.c.code,
+            TariffItem.valid_from == latest.c.valid_from,
+        ))
+        .all()
+    )
 
-    return result
+    return {t.code: t for t in items}
 
 
 # =========================================================
-# РАСЧЁТ НАЧИСЛЕНИЙ ДЛЯ ОДНОЙ КВАРТИРЫ
+# РАСЧЁТ НАЧИСЛЕНИЙ ПО КВАРТИРАМ
 # =========================================================
 
-def calculate_charges_for_apartment(
-    apt: Apartment,
+# Порядок услуг — порядок строк начислений внутри квартиры
+ITEM_CODES = ("target_fee", "radio", "antenna", "intercom", "bank_percent")
+
+
+def calculate_charges(
+    apartments: List[Apartment],
     period: date,
     tariffs: Dict[str, TariffItem],
 ) -> List[ChargeRow]:
+    """
+    Начисления сразу по всем квартирам.
+    Арифметика считается numpy по колонкам (квартира × услуга)
+    прямо в матрицу amounts, без временных массивов;
+    в ChargeRow превращаются только ненулевые позиции.
+    """
+    if not apartments:
+        return []
+
+    def column(attr: str) -> np.ndarray:
+        return np.array(
+            [float(getattr(a, attr) or 0) for a in apartments],
+            dtype=np.float64,
+        )
 
-    rows: List[ChargeRow] = []
-    total_before_percent = 0.0  # для банковского процента
+    area = column("area")
+    radio = column("radio")          # 0 / 0.5 / 1
+    antenna = column("antenna")
+    intercom = column("intercom")
+
+    amounts = np.zeros((len(apartments), len(ITEM_CODES)), dtype=np.float64)
+    present = np.zeros(amounts.shape, dtype=bool)
+    names = [""] * len(ITEM_CODES)
 
     # -------------------
     # 1. Целевой взнос
     # -------------------
     t_target = tariffs.get("target_fee")
-    if t_target and apt.area:
-        amount = float(apt.area) * float(t_target.value)
-        total_before_percent += amount
-
-        rows.append(ChargeRow(
-            apartment_id=apt.id,
-            apartment_number=apt.number,
-            period=period,
-            item_code="target_fee",
-            item_name=t_target.name,
-            amount=round(amount, 2),
-        ))
+    if t_target:
+        present[:, 0] = area != 0
+        np.multiply(area, float(t_target.value), out=amounts[:, 0])
+        names[0] = t_target.name
 
     # -------------------
     # 2. Радио
     # -------------------
     t_radio = tariffs.get("radio")
-    if t_radio and apt.radio:
-        coeff = float(apt.radio)  # 0 / 0.5 / 1
-        amount = float(t_radio.value) * coeff
-        total_before_percent += amount
-
-        rows.append(ChargeRow(
-            apartment_id=apt.id,
-            apartment_number=apt.number,
-            period=period,
-            item_code="radio",
-            item_name=t_radio.name,
-            amount=round(amount, 2),
-        ))
+    if t_radio:
+        present[:, 1] = radio != 0
+        np.multiply(radio, float(t_radio.value), out=amounts[:, 1])
+        names[1] = t_radio.name
 
     # -------------------
     # 3. Антенна
     # -------------------
     t_antenna = tariffs.get("antenna")
-    if t_antenna and apt.antenna:
-        coeff = float(apt.antenna)
-        amount = float(t_antenna.value) * coeff
-        total_before_percent += amount
-
-        rows.append(ChargeRow(
-            apartment_id=apt.id,
-            apartment_number=apt.number,
-            period=period,
-            item_code="antenna",
-            item_name=t_antenna.name,
-            amount=round(amount, 2),
-        ))
+    if t_antenna:
+        present[:, 2] = antenna != 0
+        np.multiply(antenna, float(t_antenna.value), out=amounts[:, 2])
+        names[2] = t_antenna.name
 
     # -------------------
     # 4. Домофон
     # -------------------
-    if apt.intercom and apt.intercom > 0:
-        amount = float(apt.intercom)
-        total_before_percent += amount
-
-        rows.append(ChargeRow(
-            apartment_id=apt.id,
-            apartment_number=apt.number,
-            period=period,
-            item_code="intercom",
-            item_name="Домофон",
-            amount=round(amount, 2),
-        ))
+    present[:, 3] = intercom > 0
+    amounts[:, 3] = intercom
+    names[3] = "Домофон"
 
     # -------------------
     # 5. Банковский процент (от ВСЕХ услуг)
     # -------------------
+    amounts[~present] = 0.0
+    # сумма услуг слева направо, как при построчном расчёте, без промежуточных массивов
+    total_before_percent = amounts[:, 0].copy()
+    for j in (1, 2, 3):
+        total_before_percent += amounts[:, j]
+
     t_bank = tariffs.get("bank_percent")
-    if t_bank and total_before_percent > 0:
+    if t_bank:
         percent = float(t_bank.value) / 100.0
-        amount = total_before_percent * percent
-
-        rows.append(ChargeRow(
-            apartment_id=apt.id,
-            apartment_number=apt.number,
+        present[:, 4] = total_before_percent > 0
+        np.multiply(total_before_percent, percent, out=amounts[:, 4])
+        names[4] = t_bank.name
+
+    # np.nonzero и булева выборка идут по строкам —
+    # порядок «квартира, затем услуга» сохраняется
+    apt_idx, item_idx = np.nonzero(present)
+    values = amounts[present].tolist()
+
+    return [
+        ChargeRow(
+            apartment_id=apartments[i].id,
+            apartment_number=apartments[i].number,
             period=period,
-            item_code="bank_percent",
-            item_name=t_bank.name,
-            amount=round(amount, 2),
-        ))
-
-    return rows
+            item_code=ITEM_CODES[j],
+            item_name=names[j],
+            amount=round(value, 2),
+        )
+        for i, j, value in zip(apt_idx.tolist(), item_idx.tolist(), values)
+    ]
 
 
 # =========================================================
@@ -206,27 +235,59 @@ def generate_charges(
 
     apartments = session.query(Apartment).order_by(Apartment.number).all()
 
-    all_rows: List[ChargeRow] = []
-
-    for apt in apartments:
-        rows = calculate_charges_for_apartment(apt, period, tariffs)
-        all_rows.extend(rows)
+    all_rows = calculate_charges(apartments, period, tariffs)
 
     if save_to_db:
-        # очищаем старые начисления за период
-        session.query(Charge).filter(Charge.period == period).delete()
-
-        # сохраняем новые
-        for r in all_rows:
-            session.add(Charge(
-                apartment_id=r.apartment_id,
-                period=r.period,
-                item_code=r.item_code,
-                item_name=r.item_name,
-                amount=r.amount,
-            ))
-
-        session.commit()
+        # удаление и upsert — одна транзакция: либо весь период, либо ничего
+        try:
+            # удаляем только строки, которых нет в новом расчёте
+            # (услугу отключили, квартиру убрали); остальные перезапишет upsert
+            new_keys = {(r.apartment_id, r.item_code) for r in all_rows}
+            stale_ids = [
+                charge_id
+                for charge_id, apartment_id, item_code in session.execute(
+                    select(Charge.id, Charge.apartment_id, Charge.item_code)
+                    .where(Charge.period == period)
+                )
+                if (apartment_id, item_code) not in new_keys
+            ]
+            if stale_ids:
+                # executemany по одному id — число параметров в запросе
+                # не растёт вместе с числом удаляемых строк
+                session.execute(
+                    delete(Charge.__table__)
+                    .where(Charge.id == bindparam("charge_id")),
+                    [{"charge_id": charge_id} for charge_id in stale_ids],
+                )
+
+            # сохраняем новые — INSERT с upsert через executemany,
+            # пачками по INSERT_PAGE_SIZE строк; словари параметров
+            # собираются на одну пачку, а не на весь период сразу
+            stmt = sqlite_insert(Charge.__table__)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["apartment_id", "period", "item_code"],
+                set_={
+                    "item_name": stmt.excluded.item_name,
+                    "amount": stmt.excluded.amount,
+                    "created_at": stmt.excluded.created_at,
+                },
+            )
+            for i in range(0, len(all_rows), INSERT_PAGE_SIZE):
+                session.execute(stmt, [
+                    {
+                        "apartment_id": r.apartment_id,
+                        "period": r.period,
+                        "item_code": r.item_code,
+                        "item_name": r.item_name,
+                        "amount": r.amount,
+                    }
+                    for r in all_rows[i:i + INSERT_PAGE_SIZE]
+                ])
+
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
 
     return all_rows
 
@@ -237,10 +298,10 @@ if __name__ == "__main__":
     from sqlalchemy.orm import sessionmaker
 
     engine = create_engine("sqlite:///jsk.db")
-    SessionLocal = sessionmaker(bind=engine)
+    SessionLocal = sessionmaker(bind=engine, autoflush=False)
     session = SessionLocal()
 
-    Base.metadata.create_all(engine)
+    init_schema(engine)
 
     rows = generate_charges(session, 2025, 2)
     print("Строк начислений:", len(rows))
@@ -2,13 +2,20 @@ import pandas as pd
 import re
 from datetime import datetime
 from dataclasses import dataclass
-from typing import Optional, List, Iterable, Tuple
+from typing import Optional, List, Iterable, Tuple, Union, BinaryIO
 
 from sqlalchemy import (
-    Column, Integer, String, DateTime, Numeric, Text, ForeignKey
+    Column, Integer, String, DateTime, Numeric, Text, ForeignKey, insert, select
 )
 from sqlalchemy.orm import declarative_base, relationship, Session
 
+try:
+    # Rust-ридер xlsx, заметно быстрее openpyxl; без него — openpyxl
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
 
 # ======================================================
 # МОДЕЛИ
@@ -46,6 +53,20 @@ class UnmatchedPayment(Base):
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
 
+def init_schema(engine) -> None:
+    """
+    Создание таблиц и недостающих индексов для всех моделей на Base.
+    create_all не трогает существующие таблицы — индексы, добавленные
+    в модели позже (например, уникальный ключ для upsert начислений),
+    досоздаём отдельно.
+    """
+    Base.metadata.create_all(engine)
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
 @dataclass
 class ParsedPayment:
     date: datetime
@@ -76,17 +97,21 @@ def find_column(df: pd.DataFrame, candidates: List[str]) -> Optional[str]:
     return None
 
 
+SENDER_KEYWORDS = ["сбербанк", "//", "россия", "ул", "кв", "корп"]
+SENDER_KEYWORDS_RE = re.compile(
+    "|".join(map(re.escape, SENDER_KEYWORDS)), re.IGNORECASE
+)
+
+
 def detect_sender_column(df: pd.DataFrame) -> Optional[str]:
     """
     Определяем колонку, где находится блок отправителя.
     Ищем знакомые элементы: Сбербанк, //, КВ, адресные признаки.
+    Проверяются первые 10 непустых значений колонки.
     """
-    keywords = ["сбербанк", "//", "россия", "ул", "кв", "корп"]
-
     for col in df.columns:
-        series = df[col].dropna().astype(str).str.lower()
-        match_count = sum(any(kw in row for kw in keywords) for row in series.head(10))
-        if match_count >= 1:
+        head = df[col].dropna().head(10).astype(str)
+        if head.str.contains(SENDER_KEYWORDS_RE, na=False).any():
             return col
 
     return None
@@ -96,8 +121,12 @@ def detect_sender_column(df: pd.DataFrame) -> Optional[str]:
 # ЧТЕНИЕ И НОРМАЛИЗАЦИЯ ВЫПИСКИ
 # ======================================================
 
-def read_sber_statement_excel(path: str) -> pd.DataFrame:
-    df = pd.read_excel(path, header=9, dtype=str)
+# пробелы-разделители разрядов убираем, десятичную запятую меняем на точку
+AMOUNT_TRANSLATION = str.maketrans({" ": None, ",": "."})
+
+
+def read_sber_statement_excel(path: Union[str, BinaryIO]) -> pd.DataFrame:
+    df = pd.read_excel(path, header=9, dtype=str, engine=EXCEL_ENGINE)
 
     print("FACTUAL COLUMNS:", df.columns.tolist())
 
@@ -121,13 +150,11 @@ def read_sber_statement_excel(path: str) -> pd.DataFrame:
     df_out = pd.DataFrame()
     df_out["date"] = pd.to_datetime(df[col_date], errors="coerce")
 
-    df_out["amount"] = (
-        df[col_amount]
-        .astype(str)
-        .str.replace(" ", "")
-        .str.replace(",", ".", regex=False)
+    # «1 500,00» -> «1500.00» за один проход по строкам
+    df_out["amount"] = pd.to_numeric(
+        df[col_amount].astype(str).str.translate(AMOUNT_TRANSLATION),
+        errors="coerce",
     )
-    df_out["amount"] = pd.to_numeric(df_out["amount"], errors="coerce")
 
     df_out["description"] = df[col_descr].astype(str)
 
@@ -148,65 +175,67 @@ def read_sber_statement_excel(path: str) -> pd.DataFrame:
 # РАСПОЗНАВАНИЕ КВАРТИРЫ
 # ======================================================
 
-def detect_apartment(description: str, sender_info: Optional[str]) -> Optional[int]:
+# Адрес дома ЖСК в блоке отправителя
+HOME_STREET = "болотниковская"
+HOME_HOUSE = "д 38"
+HOME_KORP = "корп 6"
+
+# Шаблоны номера квартиры компилируются один раз при импорте модуля.
+# Порядок в DESCRIPTION_APT_RES — порядок приоритета.
+SENDER_APT_RE = re.compile(r"кв[.\s]*([0-9]{1,3})")
+DESCRIPTION_APT_RES = (
+    re.compile(r";\s*0*([0-9]{1,3})\s*$"),    # ;0000000063 или ;63 в конце строки
+    re.compile(r"кв[.\s-]*([0-9]{1,3})"),      # кв. 63 / кв-63 / кв 63
+    re.compile(r"квартира\s*([0-9]{1,3})"),    # квартира 63
+)
+
+
+def detect_apartments(df: pd.DataFrame) -> pd.Series:
     """
-    Логика определения квартиры:
+    Логика определения квартиры — по всей выписке сразу, колонками:
     1) Приоритет: адрес отправителя, если совпадает с адресом дома ЖСК
     2) Fallback: назначение платежа
+    Возвращает Int64 с <NA> там, где номер не найден.
     """
-
-    HOME_STREET = "болотниковская"
-    HOME_HOUSE = "д 38"
-    HOME_KORP = "корп 6"
-
     # ---- 1. По отправителю ----
-    if sender_info:
-        text = sender_info.lower()
-
-        if HOME_STREET in text and HOME_HOUSE in text and HOME_KORP in text:
-            m = re.search(r"кв[.\s]*([0-9]{1,3})", text)
-            if m:
-                return int(m.group(1))
-
-    # ---- 2. По назначению ----
-    if description:
-        desc = description.lower().strip()
-
-        # ;0000000063 или ;63 в конце строки
-        m = re.search(r";\s*0*([0-9]{1,3})\s*$", desc)
-        if m:
-            return int(m.group(1))
-
-        # кв. 63 / кв-63 / кв 63
-        m = re.search(r"кв[.\s-]*([0-9]{1,3})", desc)
-        if m:
-            return int(m.group(1))
+    sender = df["sender_info"].fillna("").astype(str).str.lower()
+    is_home = (
+        sender.str.contains(HOME_STREET, regex=False)
+        & sender.str.contains(HOME_HOUSE, regex=False)
+        & sender.str.contains(HOME_KORP, regex=False)
+    )
+    apt = sender.where(is_home).str.extract(SENDER_APT_RE, expand=False)
 
-        # квартира 63
-        m = re.search(r"квартира\s*([0-9]{1,3})", desc)
-        if m:
-            return int(m.group(1))
+    # ---- 2. По назначению, в порядке приоритета ----
+    # strip не нужен: «;NN» допускает пробелы до конца строки,
+    # остальные шаблоны ищутся в любом месте
+    desc = df["description"].str.lower()
+    for pattern in DESCRIPTION_APT_RES:
+        apt = apt.fillna(desc.str.extract(pattern, expand=False))
 
-    return None
+    return pd.to_numeric(apt).astype("Int64")
 
 
 def parse_statement_to_payments(df: pd.DataFrame) -> List[ParsedPayment]:
-    result = []
-
-    for _, row in df.iterrows():
-        apt = detect_apartment(row["description"], row["sender_info"])
-
-        result.append(
-            ParsedPayment(
-                date=row["date"],
-                amount=row["amount"],
-                description=row["description"],
-                sender_info=row["sender_info"],
-                guessed_apartment_number=apt,
-            )
+    apts = detect_apartments(df)
+    guessed = apts.astype(object).where(apts.notna(), None)
+
+    return [
+        ParsedPayment(
+            date=date,
+            amount=amount,
+            description=description,
+            sender_info=sender_info,
+            guessed_apartment_number=apt,
         )
-
-    return result
+        for date, amount, description, sender_info, apt in zip(
+            df["date"].tolist(),
+            df["amount"].tolist(),
+            df["description"].tolist(),
+            df["sender_info"].tolist(),
+            guessed.tolist(),
+        )
+    ]
 
 
 # ======================================================
@@ -218,8 +247,20 @@ def attach_apartment_ids(
     session: Session
 ) -> Tuple[List[ParsedPayment], List[ParsedPayment]]:
 
-    apartments = session.query(Apartment).all()
-    mapping = {a.number: a.id for a in apartments}
+    payments = list(payments)
+
+    # только number/id и только для номеров, встретившихся в выписке
+    seen = {
+        p.guessed_apartment_number
+        for p in payments
+        if p.guessed_apartment_number is not None
+    }
+    mapping = {}
+    if seen:
+        mapping = dict(session.execute(
+            select(Apartment.number, Apartment.id)
+            .where(Apartment.number.in_(seen))
+        ).all())
 
     matched, unmatched = [], []
 
@@ -237,31 +278,49 @@ def attach_apartment_ids(
 # СОХРАНЕНИЕ
 # ======================================================
 
-def save_payments_to_db(session: Session, matched, unmatched):
-    for p in matched:
-        session.add(Payment(
-            apartment_id=p.apartment_id,
-            date=p.date,
-            amount=p.amount,
-            description=p.description
-        ))
+# размер пачки для пакетных INSERT (платежи и начисления)
+INSERT_PAGE_SIZE = 1000
 
-    for p in unmatched:
-        session.add(UnmatchedPayment(
-            date=p.date,
-            amount=p.amount,
-            description=p.description,
-            raw_info=str(p.sender_info)
-        ))
 
-    session.commit()
+def save_payments_to_db(session: Session, matched, unmatched):
+    """
+    Пакетная запись платежей: executemany пачками по INSERT_PAGE_SIZE
+    строк через Core-таблицы, минуя ORM. Всё — в одной транзакции.
+    """
+    try:
+        for i in range(0, len(matched), INSERT_PAGE_SIZE):
+            session.execute(insert(Payment.__table__), [
+                {
+                    "apartment_id": p.apartment_id,
+                    "date": p.date,
+                    "amount": p.amount,
+                    "description": p.description,
+                }
+                for p in matched[i:i + INSERT_PAGE_SIZE]
+            ])
+
+        for i in range(0, len(unmatched), INSERT_PAGE_SIZE):
+            session.execute(insert(UnmatchedPayment.__table__), [
+                {
+                    "date": p.date,
+                    "amount": p.amount,
+                    "description": p.description,
+                    "raw_info": str(p.sender_info),
+                }
+                for p in unmatched[i:i + INSERT_PAGE_SIZE]
+            ])
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
 
 
 # ======================================================
 # ГЛАВНАЯ ФУНКЦИЯ
 # ======================================================
 
-def import_statement(path: str, session: Session):
+def import_statement(path: Union[str, BinaryIO], session: Session):
     df = read_sber_statement_excel(path)
     parsed = parse_statement_to_payments(df)
     matched, unmatched = attach_apartment_ids(parsed, session)